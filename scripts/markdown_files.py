@@ -1,10 +1,44 @@
-from collections import defaultdict
+import functools
+import re
 from datetime import datetime
 
 import numpy as np
 import pandas as pd
 from scipy.cluster.hierarchy import fcluster, linkage
-from scipy.spatial.distance import pdist
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from tabulate import tabulate
+
+from programming_files import EARTH_RADIUS
+
+# A "{{ name }}" template placeholder, or any other literal brace
+TEMPLATE_TOKEN_RE = re.compile(r"\{\{ (\w+) \}\}|[{}]")
+
+
+@functools.lru_cache(maxsize=None)
+def read_template(filename: str) -> str:
+    """
+    Read a template from the assets/templates directory.
+
+    Parameters
+    ----------
+    filename : str
+        The template's filename.
+
+    Returns
+    -------
+    str
+        The contents of the template, as a format string with a field
+        for each ``{{ name }}`` placeholder.
+    """
+
+    with open(f"assets/templates/{filename}", "r") as f:
+        template = f.read()
+
+    # Turn placeholders into format fields and escape all other braces
+    return TEMPLATE_TOKEN_RE.sub(
+        lambda match: f"{{{match[1]}}}" if match[1] else match[0] * 2, template
+    )
 
 
 def write_index_md(df: pd.DataFrame) -> None:
@@ -19,13 +53,14 @@ def write_index_md(df: pd.DataFrame) -> None:
 
     now = datetime.now().strftime("%A %B %d at %H:%M")
 
-    with open("assets/templates/index.md", "r") as f:
-        index = f.read()
-
     # Fill in the number of repeaters and the updated date
-    index = index.replace("{{ n_repeaters }}", str(len(df)))
-    index = index.replace("{{ date_updated }}", now)
-    index = index.replace("{{ n_groups }}", str(df["Group Name"].nunique()))
+    index = read_template("index.md").format_map(
+        {
+            "n_repeaters": len(df),
+            "date_updated": now,
+            "n_groups": df["Group Name"].nunique(),
+        }
+    )
 
     with open("index.md", "w") as f:
         f.write(index)
@@ -52,41 +87,131 @@ def write_repeaters_md(df: pd.DataFrame) -> None:
         "Offset (MHz)",
         "Tone (Hz)",
     ]
-    table = (
-        df[table_cols]
-        .rename(columns={"Group Name": "Group"})
-        .to_markdown(
-            index=False,
-            disable_numparse=True,
-            colalign=[
-                "left",
-                "left",
-                "left",
-                "left",
-                "left",
-                "right",
-                "right",
-                "right",
-            ],
-        )
+    table = tabulate(
+        df[table_cols].to_numpy().tolist(),
+        headers=["Group" if col == "Group Name" else col for col in table_cols],
+        tablefmt="pipe",
+        disable_numparse=True,
+        colalign=[
+            "left",
+            "left",
+            "left",
+            "left",
+            "left",
+            "right",
+            "right",
+            "right",
+        ],
     )
 
     # Create a list of short-name-to-long-description mappings
-    association_text = ""
     associations = df.groupby("Group Name")[["Long Name", "Website"]].first()
-    for short, long, url in associations.to_records():
-        association_text += f"{short}\n: [{long}]({url})\n\n"
+    association_text = "".join(
+        f"{short}\n: [{long}]({url})\n\n"
+        for short, long, url in zip(
+            associations.index,
+            associations["Long Name"].to_numpy(),
+            associations["Website"].to_numpy(),
+        )
+    )
 
     # Write the markdown file from template
-    with open("assets/templates/repeaters.md", "r") as f:
-        maps = f.read()
-    maps = maps.replace("{{ table }}", table)
-    maps = maps.replace("{{ associations }}", association_text)
+    maps = read_template("repeaters.md").format_map(
+        {"table": table, "associations": association_text}
+    )
     with open("repeaters.md", "w") as f:
         f.write(maps)
 
 
-def write_map_md(df: pd.DataFrame, threshold: float = 0.03) -> None:
+def haversine_pdist(coords: np.ndarray) -> np.ndarray:
+    """
+    Calculate the pairwise great-circle distances between points.
+
+    This is a broadcast version of ``programming_files.distance_between``,
+    using the same Earth radius.
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        An (N, 2) array of lat / long pairs, in radians.
+
+    Returns
+    -------
+    np.ndarray
+        Condensed distance matrix in miles, in the same order as ``pdist``.
+    """
+
+    lat, lon = coords[:, 0], coords[:, 1]
+    dlat = lat[:, None] - lat[None, :]
+    dlon = lon[:, None] - lon[None, :]
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin(dlon / 2) ** 2
+    dist = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    return dist[np.triu_indices(len(coords), 1)]
+
+
+def cluster_coordinates(coords: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Hierarchically cluster coordinates, tiling them into a grid first.
+
+    Points that are not in neighbouring grid cells are always further apart
+    than the threshold, so the complete-linkage clustering only needs to run
+    within each patch of touching, occupied cells.
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        An (N, 2) array of lat / long pairs, in degrees.
+    threshold : float
+        Points are clustered together if less than this many miles apart.
+
+    Returns
+    -------
+    np.ndarray
+        A cluster label for each point.
+    """
+
+    coords = np.deg2rad(coords).astype(np.float32)
+
+    # Bucket each point into a grid cell at least the threshold across. The
+    # cells are widened in longitude so they still span the threshold at the
+    # highest latitude in the data.
+    cell_lat = threshold / EARTH_RADIUS
+    cell_lon = 2 * np.arcsin(min(np.sin(cell_lat / 2) / np.cos(np.abs(coords[:, 0]).max()), 1))
+    cells = np.floor(coords / [cell_lat, cell_lon]).astype(np.int64)
+    occupied, cell_of_point = np.unique(cells, axis=0, return_inverse=True)
+    cell_of_point = cell_of_point.reshape(-1)
+
+    # Join occupied cells that touch, including diagonally, into patches
+    cell_index = {(cx, cy): idx for idx, (cx, cy) in enumerate(occupied.tolist())}
+    edges = [
+        (idx, cell_index[(cx + dx, cy + dy)])
+        for (cx, cy), idx in cell_index.items()
+        for dx in (-1, 0, 1)
+        for dy in (-1, 0, 1)
+        if (cx + dx, cy + dy) in cell_index
+    ]
+    rows, cols = zip(*edges)
+    adjacency = coo_matrix((np.ones(len(edges)), (rows, cols)), shape=(len(occupied),) * 2)
+    _, patch_of_cell = connected_components(adjacency, directed=False)
+    patch_of_point = patch_of_cell[cell_of_point]
+
+    # Cluster each patch on its own, offsetting labels to keep them unique
+    allocations = np.zeros(len(coords), dtype=np.int64)
+    n_clusters = 0
+    order = np.argsort(patch_of_point, kind="stable")
+    for members in np.split(order, np.flatnonzero(np.diff(patch_of_point[order])) + 1):
+        if len(members) == 1:
+            labels = np.ones(1, dtype=np.int64)
+        else:
+            dist = haversine_pdist(coords[members])
+            labels = fcluster(linkage(dist, method="complete"), threshold, criterion="distance")
+        allocations[members] = labels + n_clusters
+        n_clusters += labels.max()
+
+    return allocations
+
+
+def write_map_md(df: pd.DataFrame, threshold: float = 1.7) -> None:
     """
     Write the map.md file.
 
@@ -96,44 +221,38 @@ def write_map_md(df: pd.DataFrame, threshold: float = 0.03) -> None:
         All of the repeaters.
     threshold : float, optional
         Repeaters are combined into a single pin if less
-        than this distance apart, by default 0.03.
+        than this many miles apart, by default 1.7.
     """
 
-    # Hierarchically cluster repeater lat / long pairs
-    coords = np.array(df["Coordinates"].to_list())
-    dist = pdist(coords)
-    allocations = fcluster(linkage(dist, method="complete"), threshold, criterion="distance")
-
-    # Assign each repeater's info to a cluster
-    clusters = defaultdict(list)
-    for idx, allocation in enumerate(allocations):
-        clusters[allocation].append(
-            df.iloc[idx][["Callsign", "Output (MHz)", "Coordinates"]].to_dict()
-        )
-
-    # For each cluster, create a pin on the map as LeafletJS plaintext
-    pins_list = []
-    for cluster in clusters.values():
+    # Pull out the columns we need as NumPy arrays once
+    callsigns = df["Callsign"].astype(str)
+    labels = (callsigns + " " + df["Output (MHz)"].astype(str) + "<br>").to_numpy()
+    lat = df["Lat"].to_numpy()
+    lon = df["Lon"].to_numpy()
 
-        msg = ""
-        for repeater in cluster:
-            msg += f"{repeater['Callsign']} {repeater['Output (MHz)']}<br>"
+    # Hierarchically cluster repeater lat / long pairs
+    allocations = cluster_coordinates(np.column_stack([lat, lon]), threshold)
 
-        if len(msg):
-            coords = np.mean([repeater["Coordinates"] for repeater in cluster], axis=0)
-            coords_str = f"[{coords[0]:.10f}, {coords[1]:.10f}]"
-            pins_list.append(f"L.marker({coords_str}).bindPopup('{msg}').addTo(map);")
+    # Gather each cluster's labels and centroid
+    _, first_seen, cluster_of = np.unique(allocations, return_index=True, return_inverse=True)
+    counts = np.bincount(cluster_of)
+    centroid_lat = np.bincount(cluster_of, weights=lat) / counts
+    centroid_lon = np.bincount(cluster_of, weights=lon) / counts
+    members = np.argsort(cluster_of, kind="stable")
+    messages = np.split(labels[members], np.cumsum(counts)[:-1])
 
+    # For each cluster, in order of first appearance, create a pin on the map
+    # as LeafletJS plaintext
+    pins_list = [
+        f"L.marker([{centroid_lat[k]:.10f}, {centroid_lon[k]:.10f}])"
+        f".bindPopup('{''.join(messages[k])}').addTo(map);"
+        for k in np.argsort(first_seen)
+    ]
     pins = "\n".join(pins_list)
 
     # Write the LeafletJS code to map templates
-    with open("assets/templates/map.md", "r") as f:
-        maps_md = f.read()
-    with open("assets/templates/map.html", "r") as f:
-        maps_html = f.read()
-
-    maps_md = maps_md.replace("{{ repeater_pins }}", pins)
-    maps_html = maps_html.replace("{{ repeater_pins }}", pins)
+    maps_md = read_template("map.md").format_map({"repeater_pins": pins})
+    maps_html = read_template("map.html").format_map({"repeater_pins": pins})
 
     with open("map.md", "w") as f:
         f.write(maps_md)
@@ -1,7 +1,9 @@
 import math
+import re
 from typing import List, Literal
-from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED, ZipFile
 
+import numpy as np
 import pandas as pd
 
 BAND_DEFINITIONS = {
@@ -18,6 +20,11 @@ BANDS = Literal["6m", "2m", "1.25m", "70cm", "33cm", "23cm"]
 DOWNTOWN_SEATTLE = (47.6062, -122.3321)
 METRO_DISTANCE = 20
 
+EARTH_RADIUS = 3959.0  # miles
+
+# Color code, time slot, contact and talk group from a DMR Tone string
+DMR_TONE_RE = re.compile(r"CC(?P<color>\d+)/TS(?P<slot>[12]) (?P<contact>\S+) TG/(?P<id>\d+)")
+
 
 def filter_by_band(df: pd.DataFrame, bands: List[BANDS]) -> pd.DataFrame:
     """
@@ -36,16 +43,14 @@ def filter_by_band(df: pd.DataFrame, bands: List[BANDS]) -> pd.DataFrame:
         Repeaters in the given bands.
     """
 
-    band_dfs = []
+    # Build one mask across all bands, parsing the frequencies only once
+    freqs = df["Output (MHz)"].astype(float).to_numpy()
+    in_bands = np.zeros(len(df), dtype=bool)
     for band in bands:
-        band_dfs.append(
-            df.loc[
-                (df["Output (MHz)"].astype(float) > BAND_DEFINITIONS[band][0])
-                & (df["Output (MHz)"].astype(float) < BAND_DEFINITIONS[band][1])
-            ].copy()
-        )
+        low, high = BAND_DEFINITIONS[band]
+        in_bands |= (freqs > low) & (freqs < high)
 
-    return pd.concat(band_dfs).sort_index()
+    return df.loc[in_bands].sort_index().copy()
 
 
 def filter_by_mode(df: pd.DataFrame, modes: List[str]) -> pd.DataFrame:
@@ -94,7 +99,7 @@ def distance_between(p1: tuple[float, float], p2: tuple[float, float]) -> float:
     dlat = p2[0] - p1[0]
     a = (math.sin(dlat / 2)) ** 2 + math.cos(p1[0]) * math.cos(p2[0]) * (math.sin(dlon / 2)) ** 2
     c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return 3959.0 * c
+    return EARTH_RADIUS * c
 
 
 def format_df_for_chirp(df: pd.DataFrame) -> pd.DataFrame:
@@ -123,10 +128,10 @@ def format_df_for_chirp(df: pd.DataFrame) -> pd.DataFrame:
 
     # Set the offset direction and value
     df = df.assign(Duplex=df["Offset (MHz)"].str[0])  # + or -, first char of Offset
-    df = df.assign(Offset=df["Offset (MHz)"].str[1:].apply(lambda x: f"{float(x):.06f}"))
+    df = df.assign(Offset=pd.to_numeric(df["Offset (MHz)"].str[1:]).map("{:.6f}".format))
 
     # Some columns can be reused
-    df["Comment"] = df["Callsign"] + " - " + df["Output (MHz)"]
+    df["Comment"] = df["Callsign"].str.cat(df["Output (MHz)"], sep=" - ")
     df = df.rename(
         columns={
             "Callsign": "Name",
@@ -223,43 +228,39 @@ def format_df_for_d878(df: pd.DataFrame) -> pd.DataFrame:
 
     df_878 = df_878.round(4)
 
-    is_dmr = df["Mode"] == "DMR"
-    df_878.loc[is_dmr, "Channel Type"] = "D-Digital"
-    df_878.loc[~is_dmr, "Channel Type"] = "A-Analog"
-    # Not sure why this seemingly redundant column is in the format?
-    df_878.loc[is_dmr, "DMR MODE"] = "1"
-    df_878.loc[~is_dmr, "DMR MODE"] = "0"
-
+    is_dmr = (df["Mode"] == "DMR").to_numpy()
     # Both DMR and NBFM are "narrow"
-    is_widefm = df["Mode"].isin(["FM", "Fusion"])
-    df_878.loc[is_widefm, "Band Width"] = "25K"
-    df_878.loc[~is_widefm, "Band Width"] = "12.5K"
+    is_widefm = df["Mode"].isin(["FM", "Fusion"]).to_numpy()
+    is_dcs = df["Tone (Hz)"].str.startswith("D").fillna(False).to_numpy(dtype=bool)
 
-    is_dcs = df["Tone (Hz)"].str.startswith("D")
     # TODO: Use regexp for DCS tone number between D and '[' in string?
-    df_878.loc[is_dcs, "CTCSS/DCS Encode"] = "D" + df["Tone (Hz)"].str[1:4] + "N"
-    df_878.loc[~is_dcs, "CTCSS/DCS Encode"] = df["Tone (Hz)"]
-    df_878.loc[is_dmr, "CTCSS/DCS Encode"] = None
+    tones = df["Tone (Hz)"].to_numpy()
+    dcs_tones = ("D" + df["Tone (Hz)"].str[1:4] + "N").to_numpy()
 
     # Parse Tone string with DMR attributes: e.g., "CC2/TS1 BEARS1 TG/312488"
-    dmr_codes = df.loc[is_dmr, "Tone (Hz)"].str.extract(
-        r"CC(?P<color>\d+)\/TS(?P<slot>[12]) (?P<contact>\S+) TG\/(?P<id>\d+)"
-    )
-    df_878.loc[is_dmr, "Contact"] = dmr_codes["contact"]
-    df_878.loc[is_dmr, "Contact TG/DMR ID"] = dmr_codes["id"]
-    # Bug in CPS software - fails if Color Code column is empty - even for analog channels!
-    df_878["Color Code"] = 1
-    df_878.loc[is_dmr, "Color Code"] = dmr_codes["color"]
-    df_878.loc[is_dmr, "Slot"] = dmr_codes["slot"]
+    dmr_codes = df.loc[is_dmr, "Tone (Hz)"].str.extract(DMR_TONE_RE).reindex(df.index)
 
     is_metro = df.apply(
-        lambda x: distance_between(x["Coordinates"], DOWNTOWN_SEATTLE) < METRO_DISTANCE,
+        lambda x: distance_between((x["Lat"], x["Lon"]), DOWNTOWN_SEATTLE) < METRO_DISTANCE,
         axis=1,
+    ).to_numpy(dtype=bool)
+    is_north = (df["Lat"] > DOWNTOWN_SEATTLE[0]).to_numpy()
+
+    df_878 = df_878.assign(
+        **{
+            "Channel Type": np.where(is_dmr, "D-Digital", "A-Analog"),
+            # Not sure why this seemingly redundant column is in the format?
+            "DMR MODE": np.where(is_dmr, "1", "0"),
+            "Band Width": np.where(is_widefm, "25K", "12.5K"),
+            "CTCSS/DCS Encode": np.where(is_dmr, None, np.where(is_dcs, dcs_tones, tones)),
+            "Contact": dmr_codes["contact"],
+            "Contact TG/DMR ID": dmr_codes["id"],
+            # Bug in CPS software - fails if Color Code column is empty - even for analog channels!
+            "Color Code": np.where(is_dmr, dmr_codes["color"], 1),
+            "Slot": dmr_codes["slot"],
+            "Scan List": np.where(is_metro, "Metro", np.where(is_north, "North", "South")),
+        }
     )
-    df_878.loc[is_metro, "Scan List"] = "Metro"
-    is_north = df.apply(lambda x: x["Coordinates"][0] > DOWNTOWN_SEATTLE[0], axis=1)
-    df_878.loc[~is_metro & is_north, "Scan List"] = "North"
-    df_878.loc[~is_metro & ~is_north, "Scan List"] = "South"
 
     return df_878
 
@@ -449,7 +450,7 @@ def write_d878_zip(df: pd.DataFrame) -> None:
 
     df = format_df_for_d878(df)
     # D878 CPS software requires CR/LF line endings
-    df.to_csv("assets/programming_files/d878.csv", lineterminator="\r\n")
+    csv_files = {"d878.csv": df.to_csv(lineterminator="\r\n")}
 
     # Generate a scan list for each region
     scan_lists = {region: df.loc[df["Scan List"] == region] for region in df["Scan List"].unique()}
@@ -469,7 +470,7 @@ def write_d878_zip(df: pd.DataFrame) -> None:
     df_scanlist = pd.DataFrame(rows)
     df_scanlist.index.name = "No."
     df_scanlist.index = df_scanlist.index + 1
-    df_scanlist.to_csv("assets/programming_files/d878-scanlist.csv", lineterminator="\r\n")
+    csv_files["d878-scanlist.csv"] = df_scanlist.to_csv(lineterminator="\r\n")
 
     # List of used Talk Groups needed (not DRY - but Talk Groups don't import if not present!)
     talk_groups = {
@@ -483,15 +484,17 @@ def write_d878_zip(df: pd.DataFrame) -> None:
     df_talkgroups["Call Type"] = "Group Call"
     df_talkgroups.index.name = "No."
     df_talkgroups.index = df_talkgroups.index + 1
-    df_talkgroups.to_csv("assets/programming_files/d878-talk-groups.csv", lineterminator="\r\n")
-
-    with ZipFile("assets/programming_files/d878.zip", "w") as zipf:
-        zipf.write("assets/programming_files/d878.csv", arcname="d878.csv")
-        zipf.write("assets/programming_files/d878-scanlist.csv", arcname="d878-scanlist.csv")
-        zipf.write(
-            "assets/programming_files/d878-talk-groups.csv",
-            arcname="d878-talk-groups.csv",
-        )
+    csv_files["d878-talk-groups.csv"] = df_talkgroups.to_csv(lineterminator="\r\n")
+
+    # Write each file alongside the zip, and compress it straight from memory
+    with ZipFile(
+        "assets/programming_files/d878.zip", "w", compression=ZIP_DEFLATED, compresslevel=6
+    ) as zipf:
+        for filename, contents in csv_files.items():
+            path = f"assets/programming_files/{filename}"
+            with open(path, "w", encoding="utf-8", newline="") as f:
+                f.write(contents)
+            zipf.writestr(filename, contents)
 
 
 def write_generic_csv(df: pd.DataFrame) -> None:
@@ -509,7 +512,7 @@ def write_generic_csv(df: pd.DataFrame) -> None:
     df = df.sort_index()
 
     (
-        df.drop(["Group Name", "Website", "RR#", "Coordinates"], axis=1)
+        df.drop(["Group Name", "Website", "RR#", "Lat", "Lon"], axis=1)
         .rename(columns={"Long Name": "Group"})
         .to_csv("assets/programming_files/all_rr_frequencies.csv")
     )
@@ -48,7 +48,7 @@ if __name__ == "__main__":
     statistics["Band stats"] = df["Band"].value_counts()
 
     # Find the center of mass of the repeater locations
-    repeater_coords = np.array(df["Coordinates"].tolist())
+    repeater_coords = df[["Lat", "Lon"]].to_numpy()
     center_of_mass = repeater_coords.mean(0)
     statistics["Center of mass"] = center_of_mass
 
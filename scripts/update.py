@@ -1,10 +1,17 @@
 import argparse
+import functools
+import json
+import os
+import re
 import sys
 from types import SimpleNamespace
 from typing import Union
 
+import diskcache
+import orjson
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 
 from markdown_files import write_index_md, write_map_md, write_repeaters_md
 from programming_files import (
@@ -14,6 +21,21 @@ from programming_files import (
     write_icom_csv,
 )
 
+# Reuse connections to RepeaterBook rather than opening one per request
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+# RepeaterBook results are kept on disk between runs for a week
+RB_CACHE_DIR = "assets/.rbcache"
+RB_CACHE_EXPIRE = 7 * 24 * 60 * 60  # seconds
+
+# Patterns for scraping fields out of a RepeaterBook details page
+CALL_RE = re.compile(r"msResult\.php\?call=([^&]*)")
+FREQ_RE = re.compile(r"Downlink:</td>\n<td>(.*?)</td>", re.DOTALL)
+OFFSET_RE = re.compile(r"Offset:</td>\n<td>\n(.*?) MHz", re.DOTALL)
+LATLONG_RE = re.compile(r"center: (.*)")
+TONE_RE = re.compile(r"Uplink Tone:</td>\n<td>(.*?)</td", re.DOTALL)
+
 
 def parse_args() -> Union[argparse.Namespace, SimpleNamespace]:
     """
@@ -76,10 +98,83 @@ def parse_args() -> Union[argparse.Namespace, SimpleNamespace]:
     return parser.parse_args()
 
 
+@functools.lru_cache(maxsize=None)
+def load_repeaters() -> pd.DataFrame:
+    """
+    Read the known repeaters from assets/repeaters.json.
+
+    The parsed DataFrame is cached for the rest of the run, so callers
+    should copy it before making any changes.
+
+    Returns
+    -------
+    pd.DataFrame
+        A dataframe of known repeaters.
+    """
+
+    with open("assets/repeaters.json", "rb") as f:
+        df = pd.DataFrame.from_records(orjson.loads(f.read()))
+
+    # Store each lat / long pair as two float columns rather than a list per row
+    position = df.columns.get_loc("Coordinates")
+    coords = df.pop("Coordinates")
+    df.insert(position, "Lat", coords.str[0].astype(float))
+    df.insert(position + 1, "Lon", coords.str[1].astype(float))
+
+    return df
+
+
+def save_repeaters(df: pd.DataFrame) -> None:
+    """
+    Write the known repeaters to assets/repeaters.json.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        All of the repeaters, with Lat and Lon columns.
+    """
+
+    # Turn the Lat and Lon columns back into a list of coordinates
+    df = df.copy()
+    position = df.columns.get_loc("Lat")
+    coords = [
+        [lat, lon] if pd.notna(lat) and pd.notna(lon) else None
+        for lat, lon in zip(df.pop("Lat"), df.pop("Lon"))
+    ]
+    df.insert(position, "Coordinates", coords)
+
+    with open("assets/repeaters.json", "wb") as f:
+        f.write(
+            orjson.dumps(
+                df.to_dict(orient="records"),
+                option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY,
+            )
+        )
+    load_repeaters.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def repeaterbook_cache() -> diskcache.Cache:
+    """
+    Open the on-disk cache of RepeaterBook results, creating it if needed.
+
+    Returns
+    -------
+    diskcache.Cache
+        The RepeaterBook cache.
+    """
+
+    return diskcache.Cache(RB_CACHE_DIR)
+
+
+@functools.lru_cache(maxsize=None)
 def repeater_from_repeaterbook(id_code: str) -> dict:
     """
     Extract a bunch of repeater information from RepeaterBook.
 
+    Results are cached in memory and on disk, so each ID is only
+    fetched from RepeaterBook about once a week.
+
     Parameters
     ----------
     id_code : str
@@ -95,44 +190,64 @@ def repeater_from_repeaterbook(id_code: str) -> dict:
     if id_code is None:
         return {}
 
-    # Otherwise, grab repeater info
+    # Otherwise, use the cached repeater info or grab it from RepeaterBook
+    key = ("rb", id_code)
+    repeater = repeaterbook_cache().get(key)
+    if repeater is None:
+        repeater = scrape_repeaterbook(id_code)
+        repeaterbook_cache().set(key, repeater, expire=RB_CACHE_EXPIRE)
+
+    return repeater
+
+
+def scrape_repeaterbook(id_code: str) -> dict:
+    """
+    Fetch a repeater's details page from RepeaterBook and extract its information.
+
+    Parameters
+    ----------
+    id_code : str
+        The ID code from RepeaterBook.
+
+    Returns
+    -------
+    Dict
+        A dict containing repeat information.
+    """
+
     url = f"https://www.repeaterbook.com/repeaters/details.php?state_id=53&ID={id_code}"
-    source = requests.get(url)
+    page = SESSION.get(url, timeout=10).text
 
     # Extract various pieces of information
-    call = source.text.split("msResult.php?call=")[1].split("&")[0]
+    call = CALL_RE.search(page).group(1)
 
-    freq = source.text.split("Downlink:</td>\n<td>")[1].split("</td>")[0]
+    freq = FREQ_RE.search(page).group(1)
     freq = f"{float(freq):.04f}"
     if freq[-1] == "0":
         freq = freq[:-1]
 
-    offset = source.text.split("Offset:</td>\n<td>\n")[1].split(" MHz")[0]
+    offset = OFFSET_RE.search(page).group(1)
     offset = f"{float(offset):.01f}"
     if offset[0] != "-":
         offset = f"+{offset}"
 
-    latlong = source.text.split("center: ")[1].split("\n")[0][:-1]
-
-    try:
-        tone = source.text.split("Uplink Tone:</td>\n<td>")[1].split("</td")[0]
-    except IndexError:
-        tone = ""
-
-    # Try cleaning up lat / long into a Python list
-    try:
-        latlong = eval(latlong)
-    except SyntaxError:
-        pass
+    latlong = LATLONG_RE.search(page).group(1)[:-1]
+    tone_match = TONE_RE.search(page)
+    tone = tone_match.group(1) if tone_match else ""
 
     repeater = {
         "Callsign": call,
         "Output (MHz)": freq,
         "Offset (MHz)": offset,
         "Tone (Hz)": tone,
-        "Coordinates": latlong,
     }
 
+    # Try cleaning up lat / long into a pair of floats
+    try:
+        repeater["Lat"], repeater["Lon"] = map(float, json.loads(latlong.replace("'", '"')))
+    except (json.JSONDecodeError, TypeError, ValueError):
+        pass
+
     return repeater
 
 
@@ -159,7 +274,8 @@ def repeater_from_args(args: Union[argparse.Namespace, SimpleNamespace]) -> dict
         "Output (MHz)": args.freq,
         "Offset (MHz)": args.offset,
         "Tone (Hz)": args.tone,
-        "Coordinates": [float(args.lat), float(args.lon)] if args.lat and args.lon else None,
+        "Lat": float(args.lat) if args.lat and args.lon else None,
+        "Lon": float(args.lon) if args.lat and args.lon else None,
         "Long Name": args.long_name,
         "Website": args.url,
     }
@@ -186,22 +302,28 @@ def generate_repeater_df(args: Union[argparse.Namespace, SimpleNamespace]) -> pd
     """
 
     if args.regen:
-        df = pd.read_json("assets/repeaters.json", dtype=False)
+        df = load_repeaters().copy()
         df["RR#"] = df.index + 1
         return df
 
     # Combine RepeaterBook info with user input
     repeaterbook = repeater_from_repeaterbook(args.id)
     repeaterargs = repeater_from_args(args)
-    repeater = pd.DataFrame.from_records([{**repeaterbook, **repeaterargs}])
+    repeater = pd.Series({**repeaterbook, **repeaterargs}, dtype=object)
+
+    # Every repeater needs a location for the map and the D878 scan lists
+    if pd.isna(repeater.get("Lat")) or pd.isna(repeater.get("Lon")):
+        raise ValueError(
+            f"No coordinates for {repeater.get('Callsign')}; "
+            "provide --lat and --lon, or a RepeaterBook --id with a map location."
+        )
 
-    # Combine with known repeaters
-    df = pd.read_json("assets/repeaters.json", dtype=False)
-    df = pd.concat([df, repeater], ignore_index=True)
+    # Append to the known repeaters
+    df = load_repeaters().copy()
+    df.loc[len(df)] = repeater
 
     # Save a new known repeaters file
-    df = df.reset_index(drop=True)
-    df.to_json("assets/repeaters.json", orient="records", indent=4)
+    save_repeaters(df)
 
     # Assign a Repeater Roundabout number to each repeater
     # This shouldn't be in the .json because it's not a repeater attribute
@@ -223,6 +345,11 @@ if __name__ == "__main__":
 
     args = parse_args()
 
+    # Regenerating doesn't fetch anything, but it does discard any cached
+    # RepeaterBook results so that repeaters added later are fetched fresh
+    if args.regen and os.path.isdir(RB_CACHE_DIR):
+        repeaterbook_cache().clear()
+
     df = generate_repeater_df(args)
 
     write_index_md(df)